@@ -0,0 +1,109 @@
+"""
+Benchmarks of local stages of translation. Run from `src` folder:
+
+$ python bench.py decisions -i ../data/conference_101719.tex -n 100
+$ python bench.py parse -n 100
+$ python bench.py chunks -n 20
+"""
+import argparse
+import contextlib
+import io
+import time
+import tracemalloc
+
+
+def scaled_source(input_path, scale):
+    """ Make a large document by repeating the body of a given one """
+    with open(input_path, 'r') as f:
+        source_text = f.read()
+    if '\\begin{document}' not in source_text:
+        return source_text * scale
+    begin = source_text.index('\\begin{document}') + len('\\begin{document}')
+    end = source_text.index('\\end{document}')
+    return source_text[:begin] + source_text[begin:end] * scale + source_text[end:]
+
+
+def measure(func, *args, **kwargs):
+    """ Run func quietly, return its result, time in seconds and peak of allocated memory in bytes """
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        res = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, elapsed, peak
+
+
+def bench_decisions(source_text):
+    """ Memory of parsing with a decisions counter versus a full decisions trace """
+    from parser import Parser
+
+    for verbose in [False, True]:
+        parser, elapsed, peak = measure(Parser, source_text, verbose=verbose)
+        log = parser.decisions
+        print("%-8s decisions: %s, traced nodes: %s, time: %.2fs, peak memory: %.1f MB" % (
+            'trace' if verbose else 'counts', log[True] + log[False], len(log.nodes),
+            elapsed, peak / 2**20))
+
+
+def bench_parse(source_text, workers=4):
+    """ Sequential versus parallel parsing, results must be the same """
+    from parser import Parser
+
+    parsers = []
+    for w in [1, workers]:
+        parser, elapsed, peak = measure(Parser, source_text, workers=w)
+        parsers.append(parser)
+        print("workers: %s, time: %.2fs" % (w, elapsed))
+    seq, par = parsers
+    print("same result:", seq.to_latex() == par.to_latex() and
+          [str(c) for c in seq.chunks] == [str(c) for c in par.chunks])
+
+
+def bench_chunks(source_text, max_size=100000):
+    """ Text assembly and split-back of large chunks, translation is an echo of the request """
+    from parser import Parser
+    from translators import GenTranslator
+
+    class EchoTranslator(GenTranslator):
+        max_text_length = max_size
+
+        def _translate(self, text, src_lang, dst_lang):
+            return text
+
+    parser, _, _ = measure(Parser, source_text)
+    expected = parser.to_latex()
+    translator, _, _ = measure(EchoTranslator, parser.chunks, verbose=False)
+    sizes = [c.estimated_size() for c in translator.chunks]
+    print("chunks: %s, mean size: %s chars" % (len(sizes), sum(sizes) // max(len(sizes), 1)))
+
+    _, elapsed, peak = measure(lambda: [c.to_text() for c in translator.chunks])
+    print("assembly time: %.3fs, peak memory: %.1f MB" % (elapsed, peak / 2**20))
+    mismatches, elapsed, peak = measure(lambda: [translator.translate_chunk(c) for c in translator.chunks])
+    print("assembly and split-back time: %.3fs, peak memory: %.1f MB" % (elapsed, peak / 2**20))
+    print("stub mismatches: %s, same result: %s" % (sum(mismatches), parser.to_latex() == expected))
+
+
+BENCHMARKS = {
+    'decisions': bench_decisions,
+    'parse': bench_parse,
+    'chunks': bench_chunks,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of translatex local stages.')
+    parser.add_argument('benchmark', choices=list(BENCHMARKS), help='benchmark to run')
+    parser.add_argument('-i', '--input', default='../data/conference_101719.tex', help='input Tex file path')
+    parser.add_argument('-n', '--scale', type=int, default=100,
+                        help='how many times to repeat the document body')
+
+    args = parser.parse_args()
+    source_text = scaled_source(args.input, args.scale)
+    print("Document size: %s chars" % len(source_text))
+    BENCHMARKS[args.benchmark](source_text)
+
+
+if __name__ == '__main__':
+    main()
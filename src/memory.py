@@ -0,0 +1,182 @@
+"""
+Translation memory snapshots: compact read-only files with sorted keys and an offset index.
+A snapshot is memory-mapped and queried by binary search without loading it into RAM,
+so many workers can share the same file.
+
+File layout (little-endian):
+    header: magic (8 bytes), number of entries N (uint64)
+    index: N entries of (key offset uint64, key length uint32, value length uint32), sorted by key
+    data: key and value bytes of each entry, value follows its key
+"""
+import argparse
+import heapq
+import mmap
+import struct
+
+MAGIC = b'TLXMEM01'
+HEADER = struct.Struct('<8sQ')
+ENTRY = struct.Struct('<QII')
+
+
+def encode_key(key: tuple) -> bytes:
+    """ (src_lang, dst_lang, text) -> bytes. Languages have no tabs, so the key is unambiguous """
+    return '\t'.join(key).encode('utf-8')
+
+
+def decode_key(key: bytes) -> tuple:
+    return tuple(key.decode('utf-8').split('\t', 2))
+
+
+class MemorySnapshot:
+    """ Read-only memory-mapped translation memory """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._size = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            self._mm.close()
+            raise ValueError(f"'{path}' is not a translation memory snapshot")
+
+    def __len__(self):
+        return self._size
+
+    def _entry(self, ix: int):
+        return ENTRY.unpack_from(self._mm, HEADER.size + ix * ENTRY.size)
+
+    def _key(self, ix: int) -> bytes:
+        offset, key_len, _ = self._entry(ix)
+        return self._mm[offset: offset + key_len]
+
+    def get(self, key: tuple, default=None):
+        target = encode_key(key)
+        lo, hi = 0, self._size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self._size:
+            return default
+        offset, key_len, value_len = self._entry(lo)
+        if self._mm[offset: offset + key_len] != target:
+            return default
+        return self._mm[offset + key_len: offset + key_len + value_len].decode('utf-8')
+
+    def __contains__(self, key: tuple):
+        return self.get(key) is not None
+
+    def raw_items(self):
+        """ Iterate over (encoded key, encoded value) pairs in sorted order """
+        for ix in range(self._size):
+            offset, key_len, value_len = self._entry(ix)
+            yield self._mm[offset: offset + key_len], \
+                self._mm[offset + key_len: offset + key_len + value_len]
+
+    def items(self):
+        for key, value in self.raw_items():
+            yield decode_key(key), value.decode('utf-8')
+
+    def close(self):
+        self._mm.close()
+
+
+def write_snapshot(path, raw_items):
+    """ Write (encoded key, encoded value) pairs sorted by key into a snapshot file """
+    # Read all the items before opening the file, since it can be one of the sources
+    raw_items = list(raw_items)
+    offset = HEADER.size + len(raw_items) * ENTRY.size
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(raw_items)))
+        for key, value in raw_items:
+            f.write(ENTRY.pack(offset, len(key), len(value)))
+            offset += len(key) + len(value)
+        for key, value in raw_items:
+            f.write(key)
+            f.write(value)
+
+
+def merge_raw_items(*sources):
+    """ Merge sorted (encoded key, encoded value) sequences, the first source wins on equal keys """
+    last_key = None
+    merged = heapq.merge(*(((key, ix, value) for key, value in source)
+                           for ix, source in enumerate(sources)))
+    for key, _, value in merged:
+        if key != last_key:
+            yield key, value
+            last_key = key
+
+
+class TranslationMemory:
+    """
+    Translation memory backed by read-only snapshots, new entries are kept in a dict.
+    Can be used as GenTranslator.memory.
+    """
+
+    def __init__(self, snapshot_paths=()):
+        self.snapshots = [MemorySnapshot(p) for p in snapshot_paths]
+        self.new = {}  # entries added during this run
+        self.removed = set()  # keys removed during this run, snapshots are read-only
+
+    def get(self, key: tuple, default=None):
+        res = self.new.get(key)
+        if res is not None:
+            return res
+        if key in self.removed:
+            return default
+        for snapshot in self.snapshots:
+            res = snapshot.get(key)
+            if res is not None:
+                return res
+        return default
+
+    def __setitem__(self, key: tuple, value: str):
+        self.new[key] = value
+        self.removed.discard(key)
+
+    def pop(self, key: tuple, default=None):
+        """ Remove an entry, also hiding it in snapshots """
+        res = self.get(key, default)
+        self.new.pop(key, None)
+        self.removed.add(key)
+        return res
+
+    def __len__(self):
+        return len(self.new) + sum(len(s) for s in self.snapshots)
+
+    def export(self, path):
+        """ Write new entries merged with the snapshots to a new snapshot, without removed entries """
+        new_items = sorted((encode_key(k), v.encode('utf-8')) for k, v in self.new.items())
+        removed = {encode_key(k) for k in self.removed}
+        items = merge_raw_items(new_items, *(s.raw_items() for s in self.snapshots))
+        write_snapshot(path, ((k, v) for k, v in items if k not in removed))
+
+    def close(self):
+        for snapshot in self.snapshots:
+            snapshot.close()
+
+
+def merge_snapshots(paths, output_path):
+    """ Merge snapshot files from several workers into one """
+    snapshots = [MemorySnapshot(p) for p in paths]
+    try:
+        write_snapshot(output_path, merge_raw_items(*(s.raw_items() for s in snapshots)))
+    finally:
+        for snapshot in snapshots:
+            snapshot.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge translation memory snapshots.')
+    parser.add_argument('snapshots', nargs='+', help='snapshot files to merge')
+    parser.add_argument('-o', '--output', required=True, help='output snapshot file path')
+
+    args = parser.parse_args()
+    merge_snapshots(args.snapshots, args.output)
+    print("Merged %s snapshots into %s" % (len(args.snapshots), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,8 @@
 import logging
+import re
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 from pylatexenc import latexwalker
 from pylatexenc.latexwalker import LatexWalker, LatexNode, LatexCharsNode, LatexGroupNode, \
@@ -78,6 +82,25 @@ MATH_ENVS = ['math', 'displaymath', 'array', 'eqnarray', 'equation', 'equation*'
              'Vmatrix', 'smallmatrix', 'cases']
 
 
+LANG_SCRIPTS = {
+    'en': re.compile('[A-Za-z\u00C0-\u024F]'),  # Latin
+    'ru': re.compile('[\u0400-\u04FF]'),  # Cyrillic
+}
+UNITS = {'nm', 'mm', 'cm', 'm', 'km', 'mg', 'g', 'kg', 'ns', 'ms', 's', 'min', 'h', 'Hz', 'kHz', 'MHz',
+         'GHz', 'THz', 'B', 'KB', 'MB', 'GB', 'TB', 'bit', 'bits', 'mV', 'V', 'kV', 'mA', 'A', 'W', 'kW',
+         'MW', 'J', 'kJ', 'K', 'dB', 'Pa', 'kPa', 'MPa', 'GPa', 'N', 'px', 'pt', 'ml', 'mL', 'L', 'mol',
+         'rad', 'deg'}
+# Words which translator returns unchanged
+CODE_WORD_PATS = [
+    re.compile(r'(?:https?|ftp)://\S+|www\.\S+'),  # URL
+    re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+'),  # email
+    re.compile(r'(?:\.{0,2}|~)/[\w./~-]+|[\w.~-]+(?:/[\w.~-]+){2,}|[\w.~-]+/[\w~-]+\.\w+'),  # path
+    re.compile(r'\w*_\w*|[a-z]+[A-Z]\w*|\w{2,}(?:\.\w{2,})+(?:\(\))?'),  # identifiers
+    re.compile(r'[-+±]?\d[\d.,]*(?:%|°[CF]?|[a-zA-Z]{1,3})?'),  # numbers
+]
+_word_strip = '.,;:!?()[]"\''
+
+
 class Filter:
     include_rules = [
         Rule(True, LatexEnvironmentNode, 'document'),
@@ -158,6 +181,34 @@ class Filter:
 
         return True
 
+    @staticmethod
+    def needs_translation(text: str, src_lang: str, dst_lang: str) -> bool:
+        """ Fast local check whether translator would change the text: it is not already in the
+        destination language and contains words, not only identifiers, URLs, numbers, etc
+        """
+        # Language by script statistics
+        src_script = LANG_SCRIPTS.get(src_lang)
+        dst_script = LANG_SCRIPTS.get(dst_lang)
+        if src_script is not None and dst_script is not None:
+            n_src = len(src_script.findall(text))
+            n_dst = len(dst_script.findall(text))
+            if n_src <= 0.1 * (n_src + n_dst):
+                return False
+
+        number_before = False
+        for word in text.split():
+            word = word.strip(_word_strip)
+            if not word or not any(c.isalpha() for c in word):
+                number_before = any(c.isdigit() for c in word)
+                continue
+            if number_before and word in UNITS:
+                number_before = False
+                continue
+            number_before = False
+            if not any(p.fullmatch(word) for p in CODE_WORD_PATS):
+                return True
+        return False
+
 
 class Chunk:
     """
@@ -208,11 +259,13 @@ class Chunk:
         # Split
         print("Splitting chunk of size %s" % est_size)
         assert len(self.tokens) % 2 == 1  # because N char tokens + N-1 separators
-        mid = len(self.tokens) // 2
-        if mid % 2 == 1:
-            mid += 1
-        chunk1 = Chunk(self.tokens[:mid - 1])
-        chunk2 = Chunk(self.tokens[mid:])
+        # Split at a separator in the middle half chosen by the text before it, not exactly in the
+        # middle, so that editing the text doesn't move the other split points
+        n = len(self.tokens)
+        separators = range(n // 4 | 1, max(n // 4 | 1, 3 * n // 4) + 1, 2)
+        mid = min(separators, key=lambda ix: zlib.crc32(self.tokens[ix - 1].chars.encode('utf-8')))
+        chunk1 = Chunk(self.tokens[:mid])
+        chunk2 = Chunk(self.tokens[mid + 1:])
         return chunk1.split_if_large(max_size) + \
                chunk2.split_if_large(max_size)
 
@@ -235,54 +288,234 @@ class Chunk:
         chunk2 = Chunk(self.tokens[token_ix+1:])
         return chunk1, chunk2
 
+    # Leading whitespaces, text, trailing whitespaces of a token
+    SPACES_PAT = re.compile(r'(\s*)(.*?)(\s*)\Z', re.DOTALL)
+
     def to_text(self):
-        # Prepare tokens for translation (translator related part)
+        """ Text to be translated: tokens with whitespaces collapsed to ' ' at the ends, joined with
+        stubs. Tokens are not modified, their whitespaces are returned to be restored after translation.
+        """
+        parts = []
         spaces_before = []
         spaces_after = []
-        NEW_LINE = 'NEW_LINE'  # used for a moment to handle '\n's
         for t in self.tokens:
             if isinstance(t, LatexCharsNode):
-                # 1) Handle trailing whitespaces since translator will lose them
-                start = 0
-                end = -1
-                while t.chars[start].isspace():
-                    start += 1
-                while t.chars[end].isspace():
-                    end -= 1
-                end += 1
-                before = t.chars[:start]
-                after = t.chars[end:] if end < 0 else ""
+                # Translator will lose trailing whitespaces, keep them
+                before, text, after = self.SPACES_PAT.match(t.chars).groups()
                 spaces_before.append(before)
                 spaces_after.append(after)
-                # Replace whitespaces with a ' ' if any
-                t.chars = "%s%s%s" % (
-                    " " if len(before) > 0 else "",
-                    t.chars[start: end or None],
-                    " " if len(after) > 0 else "")
-
-                # 2) Handle newlines  # TODO do we want to revert this after translation?
-                # '\n' -> ' '
-                # '\n\n' -> '\n'
-                # t.chars = t.chars.replace('\n\n', NEW_LINE).replace('\n', ' ').replace(NEW_LINE,
-                #                                                                        '\n')
-
-        # Text to be translated is a concatenated text of all the tokens and stubs
-        plain_text = ""
-        for t in self.tokens:
-            if isinstance(t, LatexCharsNode):
-                plain_text += t.chars
+                if before:
+                    parts.append(' ')
+                parts.append(text)
+                if after:
+                    parts.append(' ')
             else:
-                plain_text += t
+                parts.append(t)
+
+        return ''.join(parts), spaces_before, spaces_after
 
-        return plain_text, spaces_before, spaces_after
+
+SECTION_MACROS = ['part', 'chapter', 'section']
+VERBATIM_ENVS = ['verbatim', 'verbatim*', 'lstlisting', 'minted', 'comment']
+
+_special_pat = re.compile(r'[%{}\\]')
+_macro_pat = re.compile(r'\\([a-zA-Z]+\*?|.)', re.DOTALL)
+_env_pat = re.compile(r'\s*\{([^{}]*)\}')
+
+
+def find_split_points(source_text: str):
+    """
+    Scan latex source (without parsing it) and find top-level section boundaries where the document
+    can be cut into independently parsable segments: outside groups, environments (except for
+    'document'), verbatim and comments.
+    Returns (body_start, body_end, cuts), where body is the content of 'document' environment
+    (body_start/end are None if there is no one), cuts are positions of section macros.
+    """
+    body_start = body_end = None
+    cuts = []
+    depth = 0  # braces depth
+    envs = []  # stack of environments
+    n = len(source_text)
+    m = _special_pat.search(source_text)
+    while m:
+        i = m.start()
+        c = source_text[i]
+        if c == '%':
+            i = source_text.find('\n', i)
+            if i == -1:
+                break
+        elif c == '{':
+            depth += 1
+            i += 1
+        elif c == '}':
+            depth = max(0, depth - 1)
+            i += 1
+        else:
+            macro = _macro_pat.match(source_text, i)
+            if macro is None:
+                break
+            name = macro.group(1)
+            i = macro.end()
+            if name in ('verb', 'verb*') and i < n:
+                # \verb|...|
+                i = source_text.find(source_text[i], i + 1) + 1 or n
+            elif name in ('begin', 'end'):
+                env = _env_pat.match(source_text, i)
+                if env is not None:
+                    envname = env.group(1)
+                    if name == 'begin' and envname in VERBATIM_ENVS:
+                        end = source_text.find('\\end{%s}' % envname, env.end())
+                        i = n if end == -1 else end + len('\\end{%s}' % envname)
+                    elif name == 'begin':
+                        if envname == 'document' and not envs and depth == 0:
+                            body_start = env.end()
+                        envs.append(envname)
+                        i = env.end()
+                    else:
+                        if envname == 'document' and envs == ['document'] and depth == 0:
+                            body_end = macro.start()
+                        if envs:
+                            envs.pop()
+                        i = env.end()
+            elif name in SECTION_MACROS and depth == 0 and envs in ([], ['document']):
+                cuts.append(macro.start())
+        m = _special_pat.search(source_text, i)
+
+    if body_start is None or body_end is None:
+        body_start = body_end = None
+    return body_start, body_end, cuts
+
+
+def iter_nodes(nodelist: list):
+    """ Iterate over nodes and all their children, including macro arguments """
+    for node in nodelist:
+        if node is None:
+            continue
+        if isinstance(node, list):
+            yield from iter_nodes(node)
+            continue
+        yield node
+        if getattr(node, 'nodeargd', None) and node.nodeargd.argnlist:
+            yield from iter_nodes(node.nodeargd.argnlist)
+        if getattr(node, 'nodelist', None):
+            yield from iter_nodes(node.nodelist)
+
+
+def shift_pos(nodelist: list, offset: int):
+    """ Shift positions of nodes and all their children by offset """
+    for node in iter_nodes(nodelist):
+        node.pos += offset
+
+
+def set_source(nodelist: list, source_text: str):
+    """ Point parsing states of nodes and all their children to source_text, which their
+    positions refer to, so that node.latex_verbatim() works
+    """
+    states = {}  # id(old state) -> (old state, new state)
+    for node in iter_nodes(nodelist):
+        state = node.parsing_state
+        if state is None or state.s is source_text:
+            continue
+        if id(state) not in states:
+            states[id(state)] = state, state.sub_context(s=source_text)
+        node.parsing_state = states[id(state)][1]
+
+
+def parse_segment(segment: str, offset: int, parent_nodes: list, default_decision: int):
+    """
+    Parse and filter a segment of document, to be run in a worker process.
+    Returns nodes, chunks formed inside them and a chunk of tokens at the top level of the segment.
+    """
+    parser = Parser.__new__(Parser)
+    parser.chunks = []
+    parser.decisions = DecisionLog()
+
+    nodelist, pos, len_ = LatexWalker(segment).get_latex_nodes(pos=0)
+    shift_pos(nodelist, offset)
+    chunk = Chunk()
+    for node in nodelist:
+        parser.walk_node(node, parent_nodes, default_decision, chunk)
+    return nodelist, parser.chunks, chunk, parser.decisions.counts
+
+
+class DecisionLog:
+    """
+    Record of filter decisions over visited nodes.
+    By default only counts are kept. With trace=True nodes are also stored, each node keeps an index
+    of its parent in compact arrays, so the path to a node is restored on demand instead of storing a
+    copy of parent nodes list for each node.
+    """
+    __slots__ = ('counts', 'trace', 'nodes', 'parents', '_node_ix', 'decided', 'decisions')
+
+    def __init__(self, trace=False):
+        self.counts = {True: 0, False: 0}
+        self.trace = trace
+        self.nodes = []  # all traced nodes: decided ones and their parents
+        self.parents = array('l')  # index of the parent for each traced node, -1 for the root
+        self._node_ix = {}  # id(node) -> index in self.nodes
+        self.decided = array('l')  # indices of decided nodes in order of visiting
+        self.decisions = array('b')  # decision for each of self.decided
+
+    def __getitem__(self, decision: bool) -> int:
+        return self.counts[decision]
+
+    def _add_node(self, node: LatexNode, parent_ix: int, is_parent=False) -> int:
+        ix = len(self.nodes)
+        self.nodes.append(node)
+        self.parents.append(parent_ix)
+        if is_parent:
+            self._node_ix[id(node)] = ix
+        return ix
+
+    def _parent_ix(self, parent_nodes: list) -> int:
+        if len(parent_nodes) == 0:
+            return -1
+        ix = self._node_ix.get(id(parent_nodes[-1]))
+        if ix is not None:
+            return ix
+        # Parent is not traced yet, add the path to it
+        ix = -1
+        for p in parent_nodes:
+            p_ix = self._node_ix.get(id(p))
+            ix = self._add_node(p, ix, is_parent=True) if p_ix is None else p_ix
+        return ix
+
+    def update(self, counts: dict):
+        """ Add counts of decisions made elsewhere, e.g. in a worker process """
+        for decision, count in counts.items():
+            self.counts[decision] += count
+
+    def add(self, node: LatexNode, parent_nodes: list, decision: bool):
+        self.counts[decision] += 1
+        if self.trace:
+            ix = self._add_node(node, self._parent_ix(parent_nodes))
+            self.decided.append(ix)
+            self.decisions.append(decision)
+
+    def path(self, ix: int) -> list:
+        """ Nodes from the root to the traced node with a given index """
+        path = []
+        while ix != -1:
+            path.append(self.nodes[ix])
+            ix = self.parents[ix]
+        return path[::-1]
+
+    def iter_decided(self, decision: bool):
+        """ Iterate over pairs (node, parent_nodes) for a given decision. Works only with trace """
+        for ix, d in zip(self.decided, self.decisions):
+            if d == decision:
+                path = self.path(ix)
+                yield path[-1], path[:-1]
 
 
 class Parser:
     """
 
     """
+    min_parallel_size = 100000  # documents shorter than that are parsed sequentially
+    segments_per_worker = 4  # split document into more segments than workers to balance the load
 
-    def __init__(self, source_text, verbose=False):
+    def __init__(self, source_text, verbose=False, workers=1):
         self.chunks = []  # sequence of tokens and stubs lists to translate together
         self.ctr = 0
         self.source_text = source_text
@@ -290,34 +523,121 @@ class Parser:
 
         # print(LatexNodes2Text().latex_to_text(source_text))
 
-        self.decisions = {True: [], False: []}
-        w = LatexWalker(source_text)
-        self.nodelist, pos, len_ = w.get_latex_nodes(pos=0)
-        for node in self.nodelist:
-            self.walk_node(node, [], 0, Chunk())
+        self.decisions = DecisionLog(trace=verbose)
+        # Decisions trace needs the nodes from a single process
+        if workers > 1 and not verbose and len(source_text) >= self.min_parallel_size:
+            self.nodelist = self.parse_parallel(workers)
+        else:
+            self.nodelist = None
+        if self.nodelist is None:
+            w = LatexWalker(source_text)
+            self.nodelist, pos, len_ = w.get_latex_nodes(pos=0)
+            for node in self.nodelist:
+                self.walk_node(node, [], 0, Chunk())
         # self._mark_with_color()
 
         # Print decisions
         print("Parsed latex text.")
-        print("- charNodes to translate:", len(self.decisions[True]))
-        print("- charNodes not to translate:", len(self.decisions[False]))
+        print("- charNodes to translate:", self.decisions[True])
+        print("- charNodes not to translate:", self.decisions[False])
         print("- chunks:", len(self.chunks))
         print("- total length of text to translate:", sum(c.estimated_size() for c in self.chunks))
 
         if self.verbose:
             print("\n=== Nodes to translate:")
-            for node, parent_nodes in self.decisions[True]:
+            for node, parent_nodes in self.decisions.iter_decided(True):
                 prefix = '$ '
                 prefix += self.node_to_str(node)
                 # prefix += ' -> '.join(self.node_to_str(n) for n in parent_nodes + [node])
                 print(prefix)
 
             print("\n=== Nodes to NOT translate:")
-            for node, parent_nodes in self.decisions[False]:
+            for node, parent_nodes in self.decisions.iter_decided(False):
                 prefix = '$ '
                 prefix += ' -> '.join(self.node_to_str(n) for n in parent_nodes + [node])
                 print(prefix)
 
+    def _segment_bounds(self, start, end, cuts, n_segments):
+        """ Choose cuts to get about n_segments segments of similar size """
+        target = (end - start) / n_segments
+        bounds = [start]
+        for cut in cuts:
+            if start < cut < end and cut - bounds[-1] >= target:
+                bounds.append(cut)
+        if end - bounds[-1] < target / 2 and len(bounds) > 1:
+            bounds.pop()  # join a small tail to the previous segment
+        bounds.append(end)
+        return bounds
+
+    def parse_parallel(self, workers):
+        """
+        Cut the document at top-level sections, parse and filter segments in a process pool and
+        merge the results in document order. The result is the same as of a sequential parsing.
+        Returns None if the document can't be cut.
+        """
+        text = self.source_text
+        body_start, body_end, cuts = find_split_points(text)
+        has_document = body_start is not None
+        if not has_document:
+            body_start, body_end = 0, len(text)
+
+        bounds = self._segment_bounds(body_start, body_end, cuts, workers * self.segments_per_worker)
+        if len(bounds) < 3:
+            return None
+
+        # Parse everything except the document body, shift positions of the nodes after it
+        body_len = body_end - body_start
+        if has_document:
+            nodelist, pos, len_ = LatexWalker(text[:body_start] + text[body_end:]).get_latex_nodes(pos=0)
+            document = None
+            for node in nodelist:
+                if node.pos >= body_start:
+                    shift_pos([node], body_len)
+                elif isinstance(node, LatexEnvironmentNode) and node.environmentname == 'document':
+                    document = node
+                    document.len += body_len
+            if document is None:
+                return None
+            decision = Filter.decide_node(document, [], 0)
+            parent_nodes = [document]
+        else:
+            nodelist = []
+            document = None
+            decision = 0
+            parent_nodes = []
+
+        print("Parsing %s segments in %s processes" % (len(bounds) - 1, workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            segments = [text[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+            n = len(segments)
+            results = pool.map(parse_segment, segments, bounds[:-1], [parent_nodes] * n, [decision] * n)
+
+            if document is None:
+                # Top level nodes are not in a chunk
+                for seg_nodes, seg_chunks, seg_chunk, counts in results:
+                    nodelist.extend(seg_nodes)
+                    self.chunks.extend(seg_chunks)
+                    self.decisions.update(counts)
+                set_source(nodelist, text)
+                return nodelist
+
+            for node in nodelist:
+                if node is not document:
+                    self.walk_node(node, [], 0, Chunk())
+                    continue
+
+                # Same as walk_node() does for an environment
+                chunk = Chunk()
+                for seg_nodes, seg_chunks, seg_chunk, counts in results:
+                    document.nodelist.extend(seg_nodes)
+                    self.chunks.extend(seg_chunks)
+                    chunk.tokens.extend(seg_chunk.tokens)
+                    self.decisions.update(counts)
+                if not chunk.is_empty():
+                    self.chunks.append(chunk)
+        set_source(nodelist, text)
+        return nodelist
+
     def _mark_with_color(self):
         """ Debug function - add random text color to each chunk
         """
@@ -369,7 +689,7 @@ class Parser:
             return
 
         decision = Filter.decide_node(node, parent_nodes, default_decision)
-        prefix = '$ ' + ' -> '.join(self.node_to_str(n) for n in parent_nodes + [node])
+        # prefix = '$ ' + ' -> '.join(self.node_to_str(n) for n in parent_nodes + [node])
         # print(prefix, 'decision:', decision)
 
         # if isinstance(node, LatexCharsNode) and '=3' in node.chars:
@@ -378,16 +698,16 @@ class Parser:
         if isinstance(node, LatexCharsNode):
             if decision == 1:
                 ok = Filter.post_filter(node)
-                self.decisions[ok].append((node, parent_nodes))
+                self.decisions.add(node, parent_nodes, ok)
 
                 if ok:  # Append to current chunk
                     chunk.append_token(node)
             else:
-                self.decisions[False].append((node, parent_nodes))
+                self.decisions.add(node, parent_nodes, False)
             return
 
         if isinstance(node, LatexSpecialsNode):
-            self.decisions[decision == 1].append((node, parent_nodes))
+            self.decisions.add(node, parent_nodes, decision == 1)
 
         # Handle different node types
         if hasattr(node, 'nodelist'):  # LatexGroupNode, LatexEnvironmentNode, LatexMathNode
@@ -487,10 +807,29 @@ class Parser:
         # Return str for unknown node types
         return str(node)
 
-    def print_latex(self, filepath=None):
-        res = ""
+    def to_latex(self) -> str:
+        return ''.join(self.print_node(node, []) for node in self.nodelist)
+
+    def output_units(self) -> list:
+        """
+        Top level pieces of the output latex in document order: nodes or strings.
+        'document' environment is split into its children.
+        """
+        units = []
         for node in self.nodelist:
-            res += self.print_node(node, [])
+            if isinstance(node, LatexEnvironmentNode) and node.environmentname == 'document':
+                end = '\\end{%s}' % node.environmentname
+                nodelist, node.nodelist = node.nodelist, []
+                units.append(self.print_node(node, [])[:-len(end)])
+                node.nodelist = nodelist
+                units.extend(nodelist)
+                units.append(end)
+            else:
+                units.append(node)
+        return units
+
+    def print_latex(self, filepath=None):
+        res = self.to_latex()
         if filepath:
             with open(filepath, 'w') as f:
                 f.write(res)
@@ -499,14 +838,63 @@ class Parser:
             print(res)
 
 
-def translate(input_path, output_path, src_lang, dst_lang, verbose):
-    # Algorithm
-    # 1. Parse latex into a nodes tree
-    # 2. Filter which nodes contain text to be translated
-    # 3. Mask non-translatable nodes
-    # 4. Form chunks of text as requests to a translator
-    # 5. Get response from translator and parse it to detect which text belongs to which node
-    # 6. Update translatable nodes and return a new latex code
+class ProgressiveWriter:
+    """
+    Writes translated latex to a file progressively: a prefix of the document is flushed as soon as
+    all the tokens in it are translated.
+    """
+
+    def __init__(self, parser: Parser, filepath):
+        self.units = parser.output_units()
+        self.unit_of = {}  # id(LatexCharsNode) -> index of output unit containing it
+        for ix, unit in enumerate(self.units):
+            if not isinstance(unit, str):
+                for node in iter_nodes([unit]):
+                    if isinstance(node, LatexCharsNode):
+                        self.unit_of[id(node)] = ix
+
+        # Number of tokens to be translated in each unit
+        self.remaining = [0] * len(self.units)
+        for chunk in parser.chunks:
+            for t in chunk.tokens:
+                if isinstance(t, LatexCharsNode):
+                    self.remaining[self.unit_of[id(t)]] += 1
+
+        self.next_unit = 0
+        self.file = open(filepath, 'w')
+        self.flush()
+
+    def position(self, chunk: Chunk) -> int:
+        """ Index of the first output unit the chunk is in, to translate chunks in document order """
+        return min(self.unit_of[id(t)] for t in chunk.tokens if isinstance(t, LatexCharsNode))
+
+    def on_translated(self, chunk: Chunk):
+        for t in chunk.tokens:
+            if isinstance(t, LatexCharsNode):
+                self.remaining[self.unit_of[id(t)]] -= 1
+        self.flush()
+
+    def flush(self):
+        """ Write all complete units from the beginning """
+        start = self.next_unit
+        while self.next_unit < len(self.units) and self.remaining[self.next_unit] == 0:
+            unit = self.units[self.next_unit]
+            self.file.write(unit if isinstance(unit, str) else Parser.print_node(unit, []))
+            self.next_unit += 1
+        if self.next_unit > start:
+            self.file.flush()
+
+    def close(self):
+        """ Write the rest of the document, translated or not """
+        if self.next_unit < len(self.units):
+            logging.warning("Not all the text is translated.")
+            for ix in range(self.next_unit, len(self.units)):
+                self.remaining[ix] = 0
+            self.flush()
+        self.file.close()
+
+
+def check_langs(src_lang, dst_lang):
     src_lang = src_lang.lower()
     dst_lang = dst_lang.lower()
     from translators import SUPPORTED_LANGS
@@ -514,18 +902,84 @@ def translate(input_path, output_path, src_lang, dst_lang, verbose):
         raise RuntimeError(f"Source language '{src_lang}' is not supported.")
     if dst_lang not in SUPPORTED_LANGS:
         raise RuntimeError(f"Destination language '{dst_lang}' is not supported.")
+    return src_lang, dst_lang
 
-    with open(input_path, 'r') as f:
-        source_text = f.read()
 
+def translate_source(source_text, translator, dst_lang) -> str:
+    """ Translate latex source text with a given translator, return a new latex code.
+    The translator can be reused between calls, it is loaded with new chunks each time.
+    """
     parser = Parser(source_text, verbose=False)
-
-    from translators import CustomTranslator
-    translator = CustomTranslator(parser.chunks, verbose=verbose,
-                                  src_lang=src_lang, dst_lang=dst_lang)
+    translator.load(parser.chunks)
     translator.translate()
     parser.add_babel_package(dst_lang)
-    parser.print_latex(output_path)
+    return parser.to_latex()
+
+
+def translate(input_path, output_path, src_lang, dst_lang, verbose, adaptive=False, workers=1,
+              progressive=False, hedge=None, memory_paths=(), memory_out=None, record=None,
+              replay=None, replay_latency=0., verify=False):
+    # Algorithm
+    # 1. Parse latex into a nodes tree
+    # 2. Filter which nodes contain text to be translated
+    # 3. Mask non-translatable nodes
+    # 4. Form chunks of text as requests to a translator
+    # 5. Get response from translator and parse it to detect which text belongs to which node
+    # 6. Update translatable nodes and return a new latex code
+    src_lang, dst_lang = check_langs(src_lang, dst_lang)
+
+    with open(input_path, 'r') as f:
+        source_text = f.read()
+
+    parser = Parser(source_text, verbose=False, workers=workers)
+
+    from translators import CustomTranslator, ReplayTranslator, BACKENDS
+    if hedge is not None:
+        hedge = BACKENDS[hedge]([], verbose=False, src_lang=src_lang, dst_lang=dst_lang)
+    from memory import TranslationMemory
+    memory = TranslationMemory(memory_paths)
+    from verifier import Verifier
+
+    def make_translator(chunks):
+        kwargs = dict(verbose=verbose, src_lang=src_lang, dst_lang=dst_lang, adaptive=adaptive,
+                      hedge=hedge, memory=memory, record=record)
+        if replay is not None:
+            return ReplayTranslator(chunks, cassette=replay, latency=replay_latency, **kwargs)
+        return CustomTranslator(chunks, **kwargs)
+
+    if progressive:
+        # Translate in document order and write the result as soon as its beginning is ready
+        verifier = Verifier(parser) if verify else None
+        parser.add_babel_package(dst_lang)
+        writer = ProgressiveWriter(parser, output_path)
+        parser.chunks.sort(key=writer.position)
+        try:
+            translator = make_translator(parser.chunks)
+            writer.on_translated(Chunk(translator.skipped))
+            translator.translate(callback=writer.on_translated)
+        finally:
+            writer.close()
+    else:
+        verifier = Verifier(parser) if verify else None
+        translator = make_translator(parser.chunks)
+        translator.translate()
+        parser.add_babel_package(dst_lang)
+        parser.print_latex(output_path)
+
+    if verifier is not None:
+        bad = verifier.verify(parser.to_latex())
+        if bad:
+            print("Structure of %s chunks is broken, translating them again" % len(bad))
+            translator.load(verifier.restore(bad))
+            translator.translate(use_memory=False)
+            parser.print_latex(output_path)
+            bad = verifier.verify(parser.to_latex())
+            for message in verifier.messages:
+                logging.warning(message)
+    if memory_out:
+        memory.export(memory_out)
+        print("Translation memory with %s new entries saved to" % len(memory.new), memory_out)
+    memory.close()
     print("Done. See result in", output_path)
 
 
@@ -0,0 +1,184 @@
+import argparse
+import itertools
+import json
+import logging
+import queue
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from parser import check_langs, translate_source
+
+
+class Job:
+    """ One translation request from a client, waiting in the queue.
+    """
+
+    def __init__(self, source_text, src_lang, dst_lang, priority=0):
+        self.source_text = source_text
+        self.src_lang = src_lang
+        self.dst_lang = dst_lang
+        self.priority = priority
+
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LRUMemory:
+    """ Translation memory keeping at most max_entries recently used entries """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key: tuple, default=None):
+        res = self.entries.get(key)
+        if res is None:
+            return default
+        self.entries.move_to_end(key)
+        return res
+
+    def __setitem__(self, key: tuple, value: str):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def pop(self, key: tuple, default=None):
+        return self.entries.pop(key, default)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class TranslationServer:
+    """
+    Long-running translation service.
+    Backend sessions and translation memory are kept warm between requests.
+    Jobs from all clients are put to a priority queue and processed by a single worker, since
+    translator backends are rate limited and not thread-safe.
+    """
+
+    def __init__(self, translator_class=None, verbose=False, memory_size=100000):
+        if translator_class is None:
+            from translators import CustomTranslator
+            translator_class = CustomTranslator
+        self.translator_class = translator_class
+        self.verbose = verbose
+
+        self.translators = {}  # (src_lang, dst_lang) -> translator with a warm backend session
+        self.memory = LRUMemory(memory_size)  # translation memory shared by all translators
+        self.jobs = queue.PriorityQueue()
+        self._seq = itertools.count()  # keeps FIFO order among jobs of the same priority
+
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+
+    def submit(self, job: Job) -> Job:
+        # Lower value means higher priority
+        self.jobs.put((job.priority, next(self._seq), job))
+        return job
+
+    def translate(self, source_text, src_lang, dst_lang, priority=0) -> str:
+        """ Put a job to the queue and wait for its result.
+        Raises ValueError if languages are not supported or the same.
+        """
+        try:
+            src_lang, dst_lang = check_langs(src_lang, dst_lang)
+        except RuntimeError as e:
+            raise ValueError(str(e))
+        if src_lang == dst_lang:
+            raise ValueError("Source and destination languages are the same, nothing to do.")
+        job = self.submit(Job(source_text, src_lang, dst_lang, priority))
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def get_translator(self, src_lang, dst_lang):
+        key = (src_lang, dst_lang)
+        translator = self.translators.get(key)
+        if translator is None:
+            translator = self.translator_class(
+                [], src_lang=src_lang, dst_lang=dst_lang, verbose=self.verbose, memory=self.memory)
+            self.translators[key] = translator
+        return translator
+
+    def _work(self):
+        while True:
+            _, _, job = self.jobs.get()
+            try:
+                translator = self.get_translator(job.src_lang, job.dst_lang)
+                job.result = translate_source(job.source_text, translator, job.dst_lang)
+            except Exception as e:
+                logging.exception("Translation job failed")
+                job.error = e
+            finally:
+                job.done.set()
+                self.jobs.task_done()
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /translate with a JSON body
+    {"source": <latex text>, "src_lang": "en", "dst_lang": "ru", "priority": 0}
+    returns JSON {"result": <translated latex text>} or {"error": <message>}
+    """
+    server_version = "translatex"
+
+    def do_POST(self):
+        if self.path != '/translate':
+            self.send_json(404, {'error': f"Unknown path '{self.path}'"})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length))
+            result = self.server.translation_server.translate(
+                request['source'], request.get('src_lang', 'en'), request.get('dst_lang', 'ru'),
+                priority=int(request.get('priority', 0)))
+        except (ValueError, KeyError) as e:
+            self.send_json(400, {'error': f"Bad request: {e!r}"})
+            return
+        except Exception as e:
+            self.send_json(500, {'error': str(e)})
+            return
+
+        self.send_json(200, {'result': result})
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(host='127.0.0.1', port=8765, verbose=False, memory_size=100000):
+    httpd = ThreadingHTTPServer((host, port), RequestHandler)
+    httpd.translation_server = TranslationServer(verbose=verbose, memory_size=memory_size)
+    print(f"Serving translation on http://{host}:{port}/translate")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latex document translation server.')
+    parser.add_argument('--host', default='127.0.0.1', help='host to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print chunks')
+    parser.add_argument('-m', '--memory-size', type=int, default=100000,
+                        help='max number of translations kept in memory')
+
+    args = parser.parse_args()
+    serve(args.host, args.port, verbose=args.verbose, memory_size=args.memory_size)
+
+
+if __name__ == '__main__':
+    main()
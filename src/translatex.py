@@ -11,6 +11,23 @@ def main():
     # parser.add_argument('--leave-original', action='store_true', help='output .tex file path')
     parser.add_argument('-s', '--source-lang', default='en', help='source language of input document')
     parser.add_argument('-d', '--dest-lang', default='ru', help='destination language')
+    parser.add_argument('-a', '--adaptive', action='store_true',
+                        help='tune request size and concurrency by translator latency and failures')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of processes to parse a large document')
+    parser.add_argument('-p', '--progressive', action='store_true',
+                        help='translate in document order and write the output as it is ready')
+    parser.add_argument('--hedge', choices=['google3', 'google4', 'google-proxy'],
+                        help='translator to duplicate slow requests to')
+    parser.add_argument('-m', '--memory', nargs='*', default=[],
+                        help='translation memory snapshots to use')
+    parser.add_argument('--memory-out', help='save translation memory snapshot to this path')
+    parser.add_argument('--record', help='record translator requests and responses to this file')
+    parser.add_argument('--replay', help='replay translator responses recorded to this file')
+    parser.add_argument('--replay-latency', type=float, default=0.,
+                        help='simulated latency of replayed responses in seconds, -1 - as recorded')
+    parser.add_argument('--verify', action='store_true',
+                        help='check structure of the result and translate broken chunks again')
 
     args = parser.parse_args()
     print(args)
@@ -24,7 +41,12 @@ def main():
         print("Source and destination languages are the same, nothing to do.")
         return
 
-    translate(input_path, output_path, src_lang, dst_lang, verbose=args.verbose)
+    translate(input_path, output_path, src_lang, dst_lang, verbose=args.verbose,
+              adaptive=args.adaptive, workers=args.jobs, progressive=args.progressive,
+              hedge=args.hedge, memory_paths=args.memory, memory_out=args.memory_out,
+              record=args.record, replay=args.replay,
+              replay_latency=None if args.replay_latency < 0 else args.replay_latency,
+              verify=args.verify)
 
 
 if __name__ == '__main__':
@@ -1,18 +1,143 @@
 import asyncio
-import itertools
 import json
 import logging
+import queue
 import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
 from pylatexenc.latexwalker import LatexCharsNode
 
-from parser import Chunk
+from parser import Chunk, Filter
 
 SUPPORTED_LANGS = ['en', 'ru']
 SRC_LANG = 'en'
 DST_LANG = 'ru'
 
 
+def percentile(values: list, q: float) -> float:
+    """ q-th percentile of values, nearest rank """
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q / 100))]
+
+
+class DaemonPool:
+    """
+    Runs each task at once in an idle thread or a new one, tasks never wait in a queue.
+    Threads are daemons, so requests left running don't keep the process alive.
+    """
+
+    def __init__(self):
+        self._tasks = queue.SimpleQueue()
+        self._idle = 0
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args) -> Future:
+        future = Future()
+        with self._lock:
+            if self._idle > 0:
+                self._idle -= 1
+            else:
+                threading.Thread(target=self._work, daemon=True).start()
+        self._tasks.put((future, func, args))
+        return future
+
+    def _work(self):
+        while True:
+            future, func, args = self._tasks.get()
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._lock:
+                self._idle += 1
+
+
+class NotRecordedError(RuntimeError):
+    """ Request is not in the cassette of ReplayTranslator, retrying it won't help """
+
+
+class AdaptiveController:
+    """
+    Tunes request size and number of concurrent requests during a run, AIMD-style:
+    additive increase while requests are fast and successful, multiplicative decrease on slow
+    responses, stub mismatches and failures (e.g. throttling).
+    """
+
+    def __init__(self, max_size, min_size=None, max_concurrency=4, target_latency=5.0,
+                 decrease=0.5):
+        self.max_size = max_size
+        self.min_size = max_size // 8 if min_size is None else min_size
+        self.size = max_size // 2
+        self.step = max(1, max_size // 10)
+
+        self.max_concurrency = max_concurrency
+        self.concurrency = 1
+        self._window = 0.  # successes accumulated to increase concurrency by 1
+
+        self.target_latency = target_latency
+        self.decrease = decrease
+
+        self.sizes = []  # chosen request sizes, one per request
+        self.concurrencies = []  # chosen concurrency, one per request
+
+    def record(self):
+        """ Remember values chosen for the next request """
+        self.sizes.append(self.size)
+        self.concurrencies.append(self.concurrency)
+
+    def _decrease_size(self):
+        self.size = max(self.min_size, int(self.size * self.decrease))
+
+    def _decrease_concurrency(self):
+        self.concurrency = max(1, int(self.concurrency * self.decrease))
+        self._window = 0.
+
+    def on_success(self, latency, mismatches):
+        if mismatches > 0:
+            # Long requests lose stubs more often
+            self._decrease_size()
+        elif latency > self.target_latency:
+            self._decrease_size()
+            self._decrease_concurrency()
+        else:
+            self.size = min(self.max_size, self.size + self.step)
+            # +1 concurrent request per a round of successful requests
+            self._window += 1. / self.concurrency
+            if self._window >= 1:
+                self._window = 0.
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+    def on_failure(self):
+        self._decrease_size()
+        self._decrease_concurrency()
+
+    def metrics(self) -> dict:
+        return {
+            'request_size': self.size,
+            'request_size_min': min(self.sizes, default=self.size),
+            'request_size_max': max(self.sizes, default=self.size),
+            'concurrency': self.concurrency,
+            'concurrency_max': max(self.concurrencies, default=self.concurrency),
+        }
+
+
+class LineChunk(Chunk):
+    """
+    Condensed chunk: tokens are translated as paragraphs of text without stubs between them.
+    Used for tokens from chunks consisting mostly of masked latex, e.g. short words between formulas.
+    Tokens have no paragraph breaks, so newlines inside them are kept.
+    """
+    LINE_SEP = '\n\n'
+    LINE_SEP_PAT = re.compile('\n\s*\n')
+
+    def estimated_size(self):
+        return sum(len(t) + len(self.LINE_SEP) for t in self.tokens)
+
+
 class GenTranslator:
     max_text_length = 2000  # limit to request translator at once
 
@@ -21,20 +146,121 @@ class GenTranslator:
 
     CHUNK_SEP_PAT = re.compile('\n?\{CH4NK_SEP\d+\}\n?')  # FIXME only for russian
     TOKEN_SEP_PAT = re.compile('(?:\{|\(|_BOS_)\{T0KEN5EP\d+\}\} ?')
+    SEP_PAT = re.compile('%s|%s' % (CHUNK_SEP_PAT.pattern, TOKEN_SEP_PAT.pattern))  # any of stubs
+    STUB_NUM_PAT = re.compile('(?i)(CH4NK_SEP|T0KEN5EP)(\d+)')  # number of a stub
 
-    def __init__(self, chunks, src_lang=SRC_LANG, dst_lang=DST_LANG, verbose=True):
-        self.chunks = chunks
+    max_retries = 3  # attempts to translate a chunk if translator fails, in adaptive mode
+
+    # Chunks where text takes less than that share are translated in a condensed form
+    min_translatable_share = 0.5
+
+    hedge_percentile = 95  # requests slower than that are duplicated to the hedge translator
+    hedge_min_samples = 10  # latencies observed before the percentile is used
+    hedge_delay = 5.0  # seconds to wait before hedging until enough latencies are observed
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Subclasses can have their own stub patterns
+        if 'SEP_PAT' not in cls.__dict__:
+            cls.SEP_PAT = re.compile('%s|%s' % (cls.CHUNK_SEP_PAT.pattern, cls.TOKEN_SEP_PAT.pattern))
+
+    def __init__(self, chunks, src_lang=SRC_LANG, dst_lang=DST_LANG, verbose=True, memory=None,
+                 adaptive=False, hedge=None, record=None):
         self.src_lang = src_lang
         self.dst_lang = dst_lang
         self.verbose = verbose
-
+        # Translation memory: (src_lang, dst_lang, text) -> translated text.
+        # Can be shared between translators, e.g. in server mode
+        self.memory = {} if memory is None else memory
+        # Adaptive request size and concurrency, max_text_length is the upper limit then
+        self.controller = AdaptiveController(self.max_text_length) if adaptive else None
+        self.metrics = {}
+        self.use_memory = True
+        self._metrics_lock = threading.Lock()  # metrics updated from request threads
+
+        # Backend clients are not thread-safe, each thread sending requests has its own one
+        self._local = threading.local()
+
+        # Another translator to send slow requests to, the first valid answer is taken
+        self.hedge = hedge
+        self._hedge_pool = DaemonPool() if hedge is not None else None
+        # Latencies of requests to this translator, abandoned ones - as they were at that moment
+        self.latencies = []
+        self.hedge_latencies = []  # (latency of the answer taken, whether the request was hedged)
+
+        # Cassette file to record requests and responses to, see ReplayTranslator
+        self.record = record
+        self._record_lock = threading.Lock()
+        if record is not None:
+            with open(record, 'a') as f:
+                if f.tell() == 0:
+                    f.write(json.dumps({'translator': self.__class__.__name__,
+                                        'max_text_length': self.max_text_length}) + '\n')
+
+        self.load(chunks)
+        self.translator  # create a backend right away to fail early
+
+    @property
+    def translator(self):
+        """ Backend client of the current thread """
+        backend = getattr(self._local, 'backend', None)
+        if backend is None:
+            backend = self._local.backend = self.new_backend()
+        return backend
+
+    def new_backend(self):
+        """ Create a backend client which _translate() uses as self.translator """
+        return self
+
+    def load(self, chunks):
+        """ Set new chunks to translate. Backend session is kept, so translator can be reused """
+        self.chunks = chunks
         self.ctr = 0  # Count chunk separators
         self.prepare()
 
     def prepare(self):
         """ Split chunks to requests. Mask non-translatable """
+        # Skip tokens that translator would return unchanged
+        self.skipped = []
+        chunks = []
+        for chunk in self.chunks:
+            tokens = []
+            for t in chunk.tokens:
+                if Filter.needs_translation(t.chars, self.src_lang, self.dst_lang):
+                    tokens.append(t)
+                else:
+                    self.skipped.append(t)
+            if tokens:
+                chunk.tokens = tokens
+                chunks.append(chunk)
+        self.chunks = chunks
+        if self.skipped:
+            print("Skipped %s tokens of %s chars not needing translation" % (
+                len(self.skipped), sum(len(t) for t in self.skipped)))
+
+        # Tokens of chunks dominated by stubs go to condensed line chunks, placed in order
+        chunks = []
+        line_chunk = None
+        self.condensed = 0
+        for chunk in self.chunks:
+            if not self.is_stub_dominated(chunk):
+                chunks.append(chunk)
+                continue
+            self.condensed += len(chunk.tokens)
+            for t in chunk.tokens:
+                if line_chunk is None or \
+                        line_chunk.estimated_size() + len(t) + len(LineChunk.LINE_SEP) >= self.max_text_length:
+                    line_chunk = LineChunk()
+                    chunks.append(line_chunk)
+                line_chunk.append_token(t)
+        self.chunks = chunks
+        if self.condensed:
+            print("Condensed %s tokens from chunks dominated by latex" % self.condensed)
+
         # Add token separators
         for chunk in self.chunks:
+            if isinstance(chunk, LineChunk):
+                continue
             tokens = [chunk.tokens[0]]
             for t in chunk.tokens[1:]:
                 tokens.append(self.TOKEN_SEP % self.ctr)
@@ -45,12 +271,20 @@ class GenTranslator:
         # Split large chunks
         chunks = []
         for chunk in self.chunks:
+            if isinstance(chunk, LineChunk):
+                chunks.append(chunk)
+                continue
             parts = chunk.split_if_large(self.max_text_length)
             chunks.extend(parts)
         self.chunks = chunks
 
-        # Unite small chunks - to reduce requests to translator
         self.ctr = 0
+        if self.controller is not None:
+            # Chunks will be split and united during translation, according to the current request size
+            print("Prepared for translation. Chunks:", len(self.chunks))
+            return
+
+        # Unite small chunks - to reduce requests to translator
         chunks = []
         cur_len = 0
         cur_chunk = None
@@ -58,6 +292,14 @@ class GenTranslator:
             size = chunk.estimated_size()
             assert size < self.max_text_length
 
+            if isinstance(chunk, LineChunk):
+                # Is translated separately
+                if cur_chunk is not None:
+                    chunks.append(cur_chunk)
+                    cur_chunk = None
+                chunks.append(chunk)
+                continue
+
             if cur_chunk is None:
                 cur_chunk = chunk
                 cur_len = size
@@ -81,13 +323,158 @@ class GenTranslator:
         self.chunks = chunks
         print("Prepared for translation. Chunks:", len(self.chunks))
 
-    def translate(self):
-        for ix, c in enumerate(self.chunks):
-            print("Translating %s of %s text of length %s via %s" % (
-                ix, len(self.chunks), c.estimated_size(), self.translator.__class__.__name__))
-            self.translate_chunk(c)
-
-    def translate_chunk(self, chunk: Chunk):
+    def is_stub_dominated(self, chunk: Chunk) -> bool:
+        """ Whether text of chunk tokens is less than min_translatable_share of the request to be
+        formed with stubs. Tokens with paragraph breaks are not condensed, since they are lines.
+        """
+        if len(chunk.tokens) < 2:
+            return False
+        text_size = sum(len(t.chars.strip()) for t in chunk.tokens)
+        stubs_size = (len(chunk.tokens) - 1) * len(self.TOKEN_SEP % self.ctr)
+        if text_size >= self.min_translatable_share * (text_size + stubs_size):
+            return False
+        return not any('\n\n' in t.chars.strip() for t in chunk.tokens)
+
+    def translate(self, callback=None, use_memory=True):
+        """ Translate all chunks. callback(chunk) is called after each request is translated.
+        With use_memory=False translations are not taken from memory and their entries are replaced.
+        """
+        self.use_memory = use_memory
+        self.metrics = {'requests': 0, 'backend_requests': 0, 'chars': 0, 'stub_mismatches': 0,
+                        'failures': 0, 'memory_hits': 0, 'latency': 0.,
+                        'skipped_chars': sum(len(t) for t in self.skipped),
+                        'condensed_tokens': self.condensed}
+        self.latencies = []
+        self.hedge_latencies = []
+        if self.controller is not None:
+            self.translate_adaptive(callback)
+        else:
+            for ix, c in enumerate(self.chunks):
+                print("Translating %s of %s text of length %s via %s" % (
+                    ix, len(self.chunks), c.estimated_size(), self.translator.__class__.__name__))
+                self._add_metrics(c, *self._timed_translate_chunk(c))
+                if callback is not None:
+                    callback(c)
+
+        if self.metrics['requests'] > 0:
+            self.metrics['mean_latency'] = self.metrics['latency'] / self.metrics['requests']
+        if self.controller is not None:
+            self.metrics.update(self.controller.metrics())
+        if self.hedge is not None and self.hedge_latencies:
+            self.metrics['hedge_rate'] = \
+                sum(hedged for _, hedged in self.hedge_latencies) / len(self.hedge_latencies)
+            if self.latencies:
+                self.metrics['p99_latency_unhedged'] = percentile(self.latencies, 99)
+            self.metrics['p99_latency'] = percentile([l for l, _ in self.hedge_latencies], 99)
+        print("Run metrics:", ', '.join(f"{k}={v:.3g}" if isinstance(v, float) else f"{k}={v}"
+                                         for k, v in self.metrics.items()))
+
+    def translate_adaptive(self, callback=None):
+        """ Unite chunks into requests and send them concurrently, size and number of concurrent
+        requests are tuned by the controller according to latency, failures and stub mismatches.
+        """
+        pending = deque(self.chunks)
+        retries = {}  # request chunk -> number of failed attempts
+        running = {}  # future -> request chunk
+        with ThreadPoolExecutor(max_workers=self.controller.max_concurrency) as pool:
+            while pending or running:
+                while pending and len(running) < self.controller.concurrency:
+                    chunk = self._next_request(pending)
+                    self.controller.record()
+                    print("Translating text of length %s via %s, %s concurrent" % (
+                        chunk.estimated_size(), self.translator.__class__.__name__,
+                        self.controller.concurrency))
+                    running[pool.submit(self._timed_translate_chunk, chunk)] = chunk
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = running.pop(future)
+                    try:
+                        latency, mismatches = future.result()
+                    except NotRecordedError:
+                        raise
+                    except Exception as e:
+                        self.metrics['failures'] += 1
+                        self.controller.on_failure()
+                        retries[chunk] = retries.get(chunk, 0) + 1
+                        if retries[chunk] >= self.max_retries:
+                            raise
+                        logging.warning(f"Translator failed: {e!r}. Retrying later.")
+                        pending.appendleft(chunk)
+                        continue
+                    self.controller.on_success(latency, mismatches)
+                    self._add_metrics(chunk, latency, mismatches)
+                    if callback is not None:
+                        callback(chunk)
+
+    def _next_request(self, pending: deque) -> Chunk:
+        """ Split or unite next chunks from the queue into one request of at most controller.size """
+        chunk = pending.popleft()
+        if isinstance(chunk, LineChunk):
+            return chunk
+        parts = chunk.split_if_large(self.controller.size)
+        chunk = parts[0]
+        pending.extendleft(reversed(parts[1:]))
+        cur_len = chunk.estimated_size()
+        while pending and not isinstance(pending[0], LineChunk):
+            cur_len += pending[0].estimated_size() + len(self.CHUNK_SEP) + 4
+            if cur_len > self.controller.size:
+                break
+            chunk.append_stub(self.CHUNK_SEP % self.ctr)
+            self.ctr += 1
+            chunk.tokens.extend(pending.popleft().tokens)
+        return chunk
+
+    def _timed_translate_chunk(self, chunk: Chunk):
+        # Parts of a chunk split on a stub mismatch are translated one by one, keep tokens
+        # to restore if translation fails halfway
+        chars = [t.chars for t in chunk.tokens if isinstance(t, LatexCharsNode)]
+        start = time.perf_counter()
+        try:
+            mismatches = self.translate_chunk(chunk)
+        except Exception:
+            for t, c in zip((t for t in chunk.tokens if isinstance(t, LatexCharsNode)), chars):
+                t.chars = c
+            raise
+        return time.perf_counter() - start, mismatches
+
+    def _add_metrics(self, chunk: Chunk, latency, mismatches):
+        self.metrics['requests'] += 1
+        self.metrics['chars'] += chunk.estimated_size()
+        self.metrics['stub_mismatches'] += mismatches
+        self.metrics['latency'] += latency
+
+    def translate_lines(self, chunk: LineChunk) -> int:
+        """ Translate tokens as lines of a text. Returns the number of line count mismatches occurred.
+        """
+        lines = []
+        spaces = []
+        for t in chunk.tokens:
+            text = t.chars.strip()
+            start = t.chars.index(text[0])
+            spaces.append((t.chars[:start], t.chars[start + len(text):]))
+            lines.append(text)
+
+        dest_text = self.translate_text(LineChunk.LINE_SEP.join(lines)).strip()
+        dest_lines = LineChunk.LINE_SEP_PAT.split(dest_text)
+        if len(dest_lines) != len(lines):
+            if len(lines) == 1:
+                dest_lines = [dest_text]
+            else:
+                logging.warning("Lines in the translation can't be matched. Splitting and trying again.")
+                mid = len(chunk.tokens) // 2
+                return 1 + self.translate_lines(LineChunk(chunk.tokens[:mid])) + \
+                    self.translate_lines(LineChunk(chunk.tokens[mid:]))
+
+        for t, (before, after), line in zip(chunk.tokens, spaces, dest_lines):
+            t.chars = before + line.strip() + after
+        return 0
+
+    def translate_chunk(self, chunk: Chunk) -> int:
+        """ Translate chunk and update its tokens. Returns the number of stub mismatches occurred.
+        """
+        if isinstance(chunk, LineChunk):
+            return self.translate_lines(chunk)
         plain_text, spaces_before, spaces_after = chunk.to_text()
 
         # Translate plain text
@@ -101,27 +488,13 @@ class GenTranslator:
             print("\n---\n")
 
         # Split translated text back into tokens
-        parts = [dest_text]
-        for sep in [self.CHUNK_SEP_PAT, self.TOKEN_SEP_PAT]:
-            parts = itertools.chain.from_iterable([sep.split(p) for p in parts])
-        parts = list(parts)
+        parts = self.SEP_PAT.split(dest_text)
 
         # We suppose tokens list was [Token, *, Token, *, .., Token]
         if 2*len(parts)-1 != len(chunk.tokens):
-            def find_several_patterns(text: str, patterns: list) -> list:
-                """ Find all matches for a list of patterns, sorted by the occurrence order.
-                """
-                get_num = re.compile('\d+')
-                all_matches = []
-                for p in patterns:
-                    for m in re.finditer(p, text):
-                        all_matches.append((m.regs[0], m.group()))
-                all_matches.sort()
-                return [get_num.findall(m[1])[-1] for m in all_matches]
-
             # FInd the 1st token with a problem and split on it.
-            original_stubs = find_several_patterns(plain_text, [self.CHUNK_SEP_PAT, self.TOKEN_SEP_PAT])
-            found_stubs = find_several_patterns(dest_text, [self.CHUNK_SEP_PAT, self.TOKEN_SEP_PAT])
+            original_stubs = self.find_stubs(plain_text)
+            found_stubs = self.find_stubs(dest_text)
             mismatch_ix = 0
             while mismatch_ix < min(len(original_stubs), len(found_stubs)):
                 if found_stubs[mismatch_ix] != original_stubs[mismatch_ix]:
@@ -131,11 +504,10 @@ class GenTranslator:
                             f"Splitting chunk at index {mismatch_ix} and trying again. ")
             mismatch_ix = 2 * mismatch_ix + 1
             chunk1, chunk2 = chunk.split_by_token(mismatch_ix)
-            self.translate_chunk(chunk1)
-            self.translate_chunk(chunk2)
+            mismatches = 1 + self.translate_chunk(chunk1) + self.translate_chunk(chunk2)
             logging.warning(f"Manually check the result around '{chunk1[-1]} "
                             f"<latex symbols> {chunk2[0]}'")
-            return
+            return mismatches
 
             # logging.error(f"Couldn't build after translation.")
             # if not self.verbose:
@@ -150,6 +522,18 @@ class GenTranslator:
             if isinstance(t, LatexCharsNode):
                 t.chars = spaces_before[ix] + parts[ix].strip() + spaces_after[ix]
                 ix += 1
+        return 0
+
+    def find_stubs(self, text: str) -> list:
+        """ Find numbers of all chunk and token stubs, sorted by the occurrence order.
+        """
+        get_num = re.compile('\d+')
+        all_matches = []
+        for p in [self.CHUNK_SEP_PAT, self.TOKEN_SEP_PAT]:
+            for m in re.finditer(p, text):
+                all_matches.append((m.regs[0], m.group()))
+        all_matches.sort()
+        return [get_num.findall(m[1])[-1] for m in all_matches]
 
     def translate_text(self, text: str, src_lang=None, dst_lang=None) -> str:
         # if len(text) > self.max_text_length:
@@ -158,7 +542,128 @@ class GenTranslator:
         #                            len(text), self.max_text_length, text))
         # FIXME after several frequent requests it will ban your IP, what about proxies?
         # res = text.upper()
-        res = self._translate(text, src_lang or self.src_lang, dst_lang or self.dst_lang)
+        src_lang = src_lang or self.src_lang
+        dst_lang = dst_lang or self.dst_lang
+        # Chunks united into the request are kept in memory separately, with stubs numbered from 0,
+        # so that the same text gets the same key wherever it is and however chunks are united
+        pieces = self.CHUNK_SEP_PAT.split(text)
+        seps = self.CHUNK_SEP_PAT.findall(text)
+        keys = []
+        numbers = []
+        results = []
+        for piece in pieces:
+            piece_key, piece_numbers = self.renumber_stubs(piece)
+            keys.append((src_lang, dst_lang, piece_key))
+            numbers.append(piece_numbers)
+            if self.use_memory:
+                res = self.memory.get(keys[-1])
+                results.append(None if res is None else self.restore_stubs(res, piece_numbers))
+            else:
+                # Remembered translation is wrong, forget it
+                self.memory.pop(keys[-1], None)
+                results.append(None)
+        missing = [ix for ix, res in enumerate(results) if res is None]
+        with self._metrics_lock:
+            self.metrics['memory_hits'] = \
+                self.metrics.get('memory_hits', 0) + len(pieces) - len(missing)
+        if not missing:
+            return ''.join(res + sep for res, sep in zip(results, seps + ['']))
+
+        request = pieces[missing[0]] + ''.join(seps[ix - 1] + pieces[ix] for ix in missing[1:])
+        res = self._request(request, src_lang, dst_lang)
+        parts = self.CHUNK_SEP_PAT.split(res)
+        if len(parts) != len(missing):
+            # Can't match chunks, translator will split the request
+            if len(missing) == len(pieces):
+                return res
+            return self._request(text, src_lang, dst_lang)
+
+        for ix, part in zip(missing, parts):
+            part_key, part_numbers = self.renumber_stubs(part)
+            if part_numbers == numbers[ix]:
+                # Only answers with all the stubs in place are kept
+                self.memory[keys[ix]] = part_key
+            results[ix] = part
+        return ''.join(res + sep for res, sep in zip(results, seps + ['']))
+
+    def _request(self, text: str, src_lang, dst_lang) -> str:
+        with self._metrics_lock:
+            self.metrics['backend_requests'] = self.metrics.get('backend_requests', 0) + 1
+        start = time.perf_counter()
+        if self.hedge is not None:
+            res = self._translate_hedged(text, src_lang, dst_lang)
+        else:
+            res = self._translate(text, src_lang, dst_lang)
+        if self.record is not None:
+            self._record(text, src_lang, dst_lang, res, time.perf_counter() - start)
+        return res
+
+    def renumber_stubs(self, text: str):
+        """ Number stubs in text by their order. Returns the new text and the original numbers """
+        numbers = []
+
+        def renumber(m):
+            numbers.append(m.group(2))
+            return m.group(1) + str(len(numbers) - 1)
+        return self.STUB_NUM_PAT.sub(renumber, text), numbers
+
+    def restore_stubs(self, text: str, numbers: list) -> str:
+        """ Put back the original numbers of stubs in a text with renumbered stubs """
+        def restore(m):
+            ix = int(m.group(2))
+            return m.group(1) + (numbers[ix] if ix < len(numbers) else m.group(2))
+        return self.STUB_NUM_PAT.sub(restore, text)
+
+    def _record(self, text: str, src_lang, dst_lang, result: str, latency):
+        line = json.dumps({'src_lang': src_lang, 'dst_lang': dst_lang, 'text': text,
+                           'result': result, 'latency': latency}, ensure_ascii=False)
+        with self._record_lock:
+            with open(self.record, 'a') as f:
+                f.write(line + '\n')
+
+    def _translate_hedged(self, text: str, src_lang, dst_lang):
+        """
+        Request this translator, if it is slower than the percentile of observed latencies send the
+        same text to the hedge translator. The first answer with all the stubs in place is taken.
+        """
+        if len(self.latencies) >= self.hedge_min_samples:
+            delay = percentile(self.latencies, self.hedge_percentile)
+        else:
+            delay = self.hedge_delay
+        start = time.perf_counter()
+        primary = self._hedge_pool.submit(self._translate, text, src_lang, dst_lang)
+        done, _ = wait([primary], timeout=delay)
+        if done:
+            self.latencies.append(time.perf_counter() - start)
+            self.hedge_latencies.append((time.perf_counter() - start, False))
+            return primary.result()
+
+        logging.info(f"Request takes longer than {delay:.2f}s, hedging with "
+                     f"{self.hedge.__class__.__name__}")
+        secondary = self._hedge_pool.submit(self.hedge._translate, text, src_lang, dst_lang)
+        stubs = self.find_stubs(text)
+        running = {primary, secondary}
+        res = None
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            if primary in done:
+                self.latencies.append(time.perf_counter() - start)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                if self.find_stubs(future.result()) == stubs:
+                    if primary in running:
+                        # Running request can't be interrupted, it is left in its daemon thread
+                        self.latencies.append(time.perf_counter() - start)
+                    self.hedge_latencies.append((time.perf_counter() - start, True))
+                    return future.result()
+                if future is primary:
+                    res = future.result()
+
+        # No valid answer, fall back to this translator as without hedging
+        self.hedge_latencies.append((time.perf_counter() - start, True))
+        if res is None:
+            return primary.result()  # raises its exception
         return res
 
     def _translate(self, text: str, src_lang, dst_lang):
@@ -184,11 +689,9 @@ class GoogleTranslate3(GoogleTranslate):
     """ Using googletrans version 3 """
     version = "3.1.0a0"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
+    def new_backend(self):
         from googletrans import Translator
-        self.translator = Translator(raise_exception=True)
+        return Translator(raise_exception=True)
 
     def _translate(self, text: str, src_lang, dst_lang) -> str:
         return self.translator.translate(text, dest=dst_lang, src=src_lang).text
@@ -198,11 +701,9 @@ class GoogleTranslate4(GoogleTranslate):
     """ Using googletrans version 4 """
     version = "3.4.0"
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
+    def new_backend(self):
         from googletrans import Translator
-        self.translator = Translator(raise_exception=True, service_urls=['translate.google.com'])
+        return Translator(raise_exception=True, service_urls=['translate.google.com'])
 
     async def async_translate(self, text: str, src_lang, dst_lang):
         self.translator.client_type = 'gtx'
@@ -224,10 +725,11 @@ class GoogleTranslateProxy(GoogleTranslate):
     TOKEN_SEP_PAT = re.compile('\{\{(?i: ?T0KEN5EP)\d+\}\} ?')
 
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
         import googletrans
         assert googletrans.__version__ == "3.1.0-alpha"
+        super().__init__(*args, **kwargs)
+
+    def new_backend(self):
         from googletrans import Translator, urls, LANGUAGES, LANGCODES
         from googletrans.constants import SPECIAL_CASES
         from googletrans.models import Translated
@@ -291,7 +793,7 @@ class GoogleTranslateProxy(GoogleTranslate):
                                     response=response)
                 return result
 
-        self.translator = MyTranslator(raise_exception=True)
+        return MyTranslator(raise_exception=True)
 
     def _translate(self, text: str, src_lang, dst_lang) -> str:
         return self.translator.translate(text, dest=dst_lang, src=src_lang).text
@@ -301,7 +803,14 @@ class CustomTranslator(GenTranslator):
     """ Using googletrans version 4 """
 
     def __init__(self, *args, **kwargs):
+        self.max_text_length = 5000
 
+        # OK, but max 200 words per request
+        # self.TOKEN_SEP = ' __TOKENSEP%s__'
+
+        super().__init__(*args, **kwargs)
+
+    def new_backend(self):
         # Bad quality
         # from translatepy.translators.reverso import ReversoTranslate as tr
         # from translatepy.translators.libre import LibreTranslate as tr
@@ -319,14 +828,11 @@ class CustomTranslator(GenTranslator):
 
         # Good, but problems with patterns sometimes
         from translatepy.translators.yandex import YandexTranslate as tr
-        self.max_text_length = 5000
 
         # OK, but max 200 words per request
         # from translatepy.translators.translatecom import TranslateComTranslate as tr
-        # self.TOKEN_SEP = ' __TOKENSEP%s__'
 
-        super().__init__(*args, **kwargs)
-        self.translator = tr()
+        return tr()
 
     def _translate(self, text: str, src_lang, dst_lang) -> str:
         res = self.translator.translate(
@@ -334,6 +840,57 @@ class CustomTranslator(GenTranslator):
         return res.result
 
 
+class ReplayTranslator(GenTranslator):
+    """
+    Serves responses recorded by a translator with record=<cassette path>, without network.
+    Requests must be the same as recorded, i.e. the same document and settings.
+    """
+
+    def __init__(self, *args, cassette=None, latency=0., **kwargs):
+        """
+        :param cassette: path to a file recorded with GenTranslator(record=...)
+        :param latency: simulated latency of each response in seconds, None - as recorded
+        """
+        self.latency = latency
+        self.responses = {}  # (src_lang, dst_lang, text) -> deque of (result, latency)
+        with open(cassette, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                if 'translator' in entry:
+                    # Use the same request size and stubs as the recorded translator
+                    self.max_text_length = entry['max_text_length']
+                    recorded = next((c for c in BACKENDS.values()
+                                     if c.__name__ == entry['translator']), GenTranslator)
+                    for attr in ['CHUNK_SEP', 'TOKEN_SEP', 'CHUNK_SEP_PAT', 'TOKEN_SEP_PAT', 'SEP_PAT',
+                                 'STUB_NUM_PAT']:
+                        setattr(self, attr, getattr(recorded, attr))
+                    continue
+                key = (entry['src_lang'], entry['dst_lang'], entry['text'])
+                self.responses.setdefault(key, deque()).append((entry['result'], entry['latency']))
+
+        super().__init__(*args, **kwargs)
+
+    def _translate(self, text: str, src_lang, dst_lang) -> str:
+        responses = self.responses.get((src_lang, dst_lang, text))
+        if not responses:
+            raise NotRecordedError(
+                f"No recorded response for request {src_lang}->{dst_lang} of length {len(text)}: "
+                f"'{text[:200]}'. Replay needs the same document and settings as recorded.")
+        # Repeated requests get responses in the recorded order, the last one is kept
+        result, latency = responses.popleft() if len(responses) > 1 else responses[0]
+        time.sleep(latency if self.latency is None else self.latency)
+        return result
+
+
+# Translators by name, e.g. to use as a hedge
+BACKENDS = {
+    'google3': GoogleTranslate3,
+    'google4': GoogleTranslate4,
+    'google-proxy': GoogleTranslateProxy,
+    'custom': CustomTranslator,
+}
+
+
 if __name__ == '__main__':
     text = """
 This proof only uses Lemma {{CH4NK_SEP23}}, which provides a relation between the residuals {{T0KEN5EP159}} and {{T0KEN5EP160}}. It repeats the corresponding proof in the real case. For completeness we present this proof here. It is clear that it suffices to consider the case  {{T0KEN5EP161}}. Otherwise,  {{T0KEN5EP162}}. Also, assume  {{T0KEN5EP163}} (otherwise Theorem {{T0KEN5EP164}} holds trivially). Then, by Remark {{T0KEN5EP165}} we have  {{T0KEN5EP166}} for all  {{T0KEN5EP167}}. By Lemma {{T0KEN5EP168}} we obtain  {{T0KEN5EP169}} We choose {{T0KEN5EP170}} from the equation  {{T0KEN5EP171}} which implies that  {{T0KEN5EP172}} Define  {{T0KEN5EP173}} Using notation  {{T0KEN5EP174}}, we deduce from {{T0KEN5EP175}}
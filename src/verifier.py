@@ -0,0 +1,226 @@
+"""
+Structural verification of translated latex. Output is reparsed and its skeleton (macros,
+environments, math, groups, comments) is compared to the source one, text is not compared.
+Differences are mapped to the source chunks so that only they can be retranslated.
+
+$ python verifier.py -i ../data/example.tex -o ../data/output.tex
+"""
+import argparse
+import re
+import sys
+import time
+
+from pylatexenc.latexwalker import LatexWalker, LatexCharsNode, LatexGroupNode, LatexCommentNode, \
+    LatexMacroNode, LatexEnvironmentNode, LatexSpecialsNode, LatexMathNode
+
+from parser import Chunk, Parser
+
+STUB_PAT = re.compile('(?i)T0KEN5EP|CH4NK_SEP')  # remains of stubs in translated text
+BABEL_COMMENT = ' added language package'  # see Parser.add_babel_package()
+
+
+def is_babel_package(node) -> bool:
+    if not isinstance(node, LatexMacroNode) or node.macroname != 'usepackage':
+        return False
+    args = node.nodeargd.argnlist if node.nodeargd else []
+    return any(isinstance(arg, LatexGroupNode) and arg.nodelist and
+               isinstance(arg.nodelist[0], LatexCharsNode) and arg.nodelist[0].chars == 'babel'
+               for arg in args)
+
+
+def skeleton(nodelist: list, chunk_of: dict = None) -> list:
+    """
+    Sequence of structural items of the nodes tree in document order. Consecutive text (chars and
+    specials) is collapsed into one ['T', text, chunk indices] item, other items are tuples.
+    Whitespace-only text is dropped.
+    Babel package, which is added on translation, is skipped.
+    """
+    chunk_of = chunk_of or {}
+    items = []
+
+    def add_text(text, chunk_ix=None):
+        if not items or items[-1][0] != 'T':
+            items.append(['T', '', set()])
+        items[-1][1] += text
+        if chunk_ix is not None:
+            items[-1][2].add(chunk_ix)
+
+    def walk(nodes):
+        for node in nodes:
+            if node is None:
+                continue
+            if isinstance(node, list):
+                walk(node)
+            elif isinstance(node, LatexCharsNode):
+                add_text(node.chars, chunk_of.get(id(node)))
+            elif isinstance(node, LatexSpecialsNode):
+                add_text(node.specials_chars)
+            elif isinstance(node, LatexCommentNode):
+                if node.comment != BABEL_COMMENT:
+                    items.append(('%', node.comment))
+            elif isinstance(node, LatexMathNode):
+                # Math is never translated, compare it as a whole
+                items.append(('$', Parser.print_node(node, [])))
+            elif isinstance(node, LatexMacroNode):
+                if is_babel_package(node):
+                    continue
+                items.append(('\\', node.macroname))
+                if node.nodeargd and node.nodeargd.argnlist:
+                    walk(node.nodeargd.argnlist)
+            elif isinstance(node, LatexEnvironmentNode):
+                items.append(('begin', node.environmentname))
+                if node.nodeargd and node.nodeargd.argnlist:
+                    walk(node.nodeargd.argnlist)
+                walk(node.nodelist)
+                items.append(('end', node.environmentname))
+            elif isinstance(node, LatexGroupNode):
+                items.append(('{', node.delimiters[0]))
+                walk(node.nodelist)
+                items.append(('}', node.delimiters[1]))
+
+    walk(nodelist)
+    # Whitespace between nodes is not a structure
+    return [item for item in items if item[0] != 'T' or item[1].strip()]
+
+
+def items_match(a, b) -> bool:
+    if a[0] == 'T':
+        return b[0] == 'T'
+    return a == b
+
+
+# Offsets in source and output skeletons to try to get in sync after a mismatch,
+# nearest first. Bounded lookahead keeps alignment linear.
+RESYNC_DISTANCE = 10
+RESYNC_SHIFTS = sorted(((di, dk) for di in range(RESYNC_DISTANCE + 1) for dk in range(RESYNC_DISTANCE + 1)
+                        if 0 < di + dk <= RESYNC_DISTANCE), key=lambda x: (x[0] + x[1], abs(x[0] - x[1])))
+RESYNC_MATCHES = 3  # number of matching items needed to consider skeletons in sync
+
+
+def align(src: list, out: list):
+    """
+    Walk two skeletons in lockstep, resynchronizing after local differences with a bounded
+    lookahead, so it takes linear time.
+    Returns matched pairs of indices and indices of source items where mismatches start.
+    If skeletons can't be synced, the last mismatch index is followed by the rest of the source.
+    """
+    n, m = len(src), len(out)
+    pairs = []
+    mismatches = []
+    i = k = 0
+    while i < n and k < m:
+        if items_match(src[i], out[k]):
+            pairs.append((i, k))
+            i += 1
+            k += 1
+            continue
+
+        mismatches.append(i)
+        for di, dk in RESYNC_SHIFTS:
+            if i + di >= n or k + dk >= m:
+                continue
+            if all(items_match(src[i + di + t], out[k + dk + t])
+                   for t in range(min(RESYNC_MATCHES, n - i - di, m - k - dk))):
+                i += di
+                k += dk
+                break
+        else:
+            # Lost sync, everything left differs
+            mismatches.extend(range(i + 1, n))
+            return pairs, mismatches
+
+    if i < n or k < m:
+        mismatches.extend(range(i, n) if i < n else [n - 1])
+    return pairs, mismatches
+
+
+class Verifier:
+    """
+    Keeps the skeleton of the source document. Must be created before translation, since
+    translator modifies chunks.
+    """
+
+    def __init__(self, parser: Parser):
+        self.chunks = [list(c.tokens) for c in parser.chunks]
+        chunk_of = {}
+        for ix, tokens in enumerate(self.chunks):
+            for t in tokens:
+                chunk_of[id(t)] = ix
+        self.original = {id(t): t.chars for tokens in self.chunks for t in tokens}
+        self.items = skeleton(parser.nodelist, chunk_of)
+        self.messages = []
+
+    def verify(self, output_text: str) -> list:
+        """ Compare output to the source, return sorted indices of the chunks which differ.
+        Descriptions of the differences are in self.messages.
+        """
+        start = time.perf_counter()
+        nodelist, pos, len_ = LatexWalker(output_text, tolerant_parsing=True).get_latex_nodes(pos=0)
+        src = self.items
+        out = skeleton(nodelist)
+        self.messages = []
+        bad = set()
+
+        pairs, mismatches = align(src, out)
+        for i in mismatches:
+            # Damage is caused by the text at or next to the different item
+            for item in src[max(0, i - 1): i + 1]:
+                if item[0] == 'T':
+                    bad.update(item[2])
+        if mismatches:
+            i = mismatches[0]
+            k = next((k + i - j for j, k in reversed(pairs) if j < i), i)
+            self.messages.append("Structure differs from item %s: expected %s, found %s" % (
+                i, self._item_str(src[i]), self._item_str(out[k] if k < len(out) else None)))
+
+        # Stubs left in the translated text
+        for i, k in pairs:
+            if src[i][0] == 'T' and src[i][2] and STUB_PAT.search(out[k][1]):
+                bad.update(src[i][2])
+                self.messages.append("Stub left in text: '%s'" % out[k][1].strip()[:100])
+
+        print("Verified in %.1f ms: %s chunks differ" % (
+            1000 * (time.perf_counter() - start), len(bad)))
+        return sorted(bad)
+
+    @staticmethod
+    def _item_str(item) -> str:
+        if item is None:
+            return 'end of document'
+        if item[0] == 'T':
+            return "text '%s'" % item[1].strip()[:50]
+        return ' '.join(str(x) for x in item)
+
+    def restore(self, chunk_indices: list) -> list:
+        """ Restore the source text of given chunks, return them to be translated again """
+        chunks = []
+        for ix in chunk_indices:
+            tokens = self.chunks[ix]
+            for t in tokens:
+                t.chars = self.original[id(t)]
+            chunks.append(Chunk(list(tokens)))
+        return chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify structure of translated latex document.')
+    parser.add_argument('-i', '--input', required=True, help='source Tex file path')
+    parser.add_argument('-o', '--output', required=True, help='translated Tex file path')
+
+    args = parser.parse_args()
+    with open(args.input, 'r') as f:
+        source_text = f.read()
+    with open(args.output, 'r') as f:
+        output_text = f.read()
+
+    verifier = Verifier(Parser(source_text))
+    bad = verifier.verify(output_text)
+    for message in verifier.messages:
+        print(message)
+    if bad:
+        print("Chunks to retranslate:", bad)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()